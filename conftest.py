@@ -0,0 +1 @@
+# Root conftest: makes pytest put the repo root on sys.path, so tests/ can import pag_core
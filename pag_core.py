@@ -0,0 +1,521 @@
+# -----------------------------------------------------------
+# PAG pipeline core: parsing, downcount and delta logic shared by the
+# FastAPI endpoints in main.py
+# -----------------------------------------------------------
+import pandas as pd
+import numpy as np
+import hashlib
+import io
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from datetime import date, datetime
+from numba import njit
+from python_calamine import CalamineWorkbook
+from openpyxl import Workbook
+from openpyxl.writer.excel import ExcelWriter
+
+# EBU sheet names
+EBU_SHEETS = [
+    "Toulouse Shipments", "Pylon Shipments", "Hamburg Shipments",
+    "Rogerville Shipments", "Morocco Shipments", "Tianjin Shipments"
+]
+SPECIAL_HEADER_SHEETS = {
+    "Toulouse Shipments", "Rogerville Shipments",
+    "Morocco Shipments", "Tianjin Shipments"
+}
+
+# Cell strings read_excel treats as missing by default (its na_values)
+NA_STRINGS = frozenset({
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan",
+    "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL", "NaN", "None",
+    "n/a", "nan", "null",
+})
+
+def read_excel(file, **kw):
+    return pd.read_excel(file, engine="calamine", **kw)
+
+# -----------------------------------------------------------
+# PARSE CACHE: re-uploads of the same workbook skip the Excel parse.
+# Keyed by content hash; callers always get their own copy.
+# -----------------------------------------------------------
+PARSE_CACHE_SIZE = 8
+_parse_cache = OrderedDict()
+_parse_cache_lock = threading.Lock()
+
+def _copy_parsed(result):
+    if isinstance(result, tuple):
+        return tuple(df.copy() for df in result)
+    return result.copy()
+
+def cached_parse(parse, data, **kw):
+    key = (parse.__name__, hashlib.blake2b(data, digest_size=16).digest(), tuple(sorted(kw.items())))
+
+    with _parse_cache_lock:
+        result = _parse_cache.get(key)
+        if result is not None:
+            _parse_cache.move_to_end(key)
+
+    if result is None:
+        result = parse(io.BytesIO(data), **kw)
+        with _parse_cache_lock:
+            _parse_cache[key] = result
+            while len(_parse_cache) > PARSE_CACHE_SIZE:
+                _parse_cache.popitem(last=False)
+
+    return _copy_parsed(result)
+
+# -----------------------------------------------------------
+# CLEAN PO NUMBERS TO INTEGERS
+# -----------------------------------------------------------
+def clean_po(po):
+    if pd.isna(po):
+        return None
+
+    po_str = str(po).strip()
+
+    if "." in po_str:
+        po_str = po_str.split(".")[0]
+
+    if "e" in po_str.lower():
+        try:
+            return int(float(po_str))
+        except:
+            return None
+
+    po_str = po_str.replace(",", "").replace(" ", "")
+
+    try:
+        return int(po_str)
+    except:
+        return None
+
+# -----------------------------------------------------------
+# Helper: float64 quantity columns (non-numeric cells -> NaN), so the
+# downcount kernel and groupby sums work on one contiguous float block
+# -----------------------------------------------------------
+def to_float(df, cols):
+    for col in cols:
+        if df[col].dtype != np.float64:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(np.float64)
+
+
+# -----------------------------------------------------------
+# Helper: cast columns to one shared, sorted CategoricalDtype so
+# comparisons, groupbys and merges between them run on integer codes
+# -----------------------------------------------------------
+def shared_categories(*columns):
+    # Empty columns (e.g. no EBU rows) are left out so they can't change the categories' dtype
+    values = pd.concat([c for c in columns if len(c)] or list(columns), ignore_index=True)
+    _, categories = pd.factorize(values, sort=True)
+    dtype = pd.CategoricalDtype(categories)
+    return [col.astype(dtype) for col in columns]
+
+
+# -----------------------------------------------------------
+# Helper: dates from values starting with YYYYMMDD (e.g. PackingSlip)
+# -----------------------------------------------------------
+def parse_yyyymmdd(values):
+    if pd.api.types.is_integer_dtype(values):
+        # Exact int64 digit count and shift: float64 log10 rounds 17+ digit values
+        n = values.to_numpy(dtype=np.int64, na_value=0)
+        valid = n >= 10_000_000
+        digits = np.searchsorted(10 ** np.arange(19, dtype=np.int64), n, side="right")
+        ymd = np.where(valid, n // 10 ** np.where(valid, digits - 8, 0), np.nan)
+    elif pd.api.types.is_numeric_dtype(values):
+        n = values.to_numpy(dtype=float)
+        valid = np.isfinite(n) & (n >= 1e7)
+        digits = np.floor(np.log10(np.where(valid, n, 1))) + 1
+        ymd = np.where(valid, np.floor(n / 10 ** (digits - 8)), np.nan)
+    else:
+        head = values.astype("string").str.slice(0, 8)
+        valid = ((head.str.len() == 8) & head.str.isdigit()).fillna(False)
+        ymd = pd.to_numeric(head.where(valid), errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+    return pd.to_datetime(
+        pd.DataFrame({"year": ymd // 10000, "month": ymd // 100 % 100, "day": ymd % 100}, index=values.index),
+        errors="coerce"
+    )
+
+
+# -----------------------------------------------------------
+# Helper: downcount "Qty remaining to deliver" per (Part, PO) group
+# keys: df's (Part, PO) columns
+# removals: one Series of qty to remove per round, indexed by (Part, PO);
+#   rounds are applied in order, all in a single pass over df
+# -----------------------------------------------------------
+@njit("void(float64[:], int64[:], int64[:], float64[:, :])", cache=True, nogil=True)
+def _downcount_kernel(qty, positions, offsets, removals):
+    for g in range(removals.shape[0]):
+        for r in range(removals.shape[1]):
+            qty_to_remove = removals[g, r]
+            for k in range(offsets[g], offsets[g + 1]):
+                if qty_to_remove <= 0:
+                    break
+                i = positions[k]
+                available = qty[i]
+                if available > 0:  # also skips NaN
+                    if available <= qty_to_remove:
+                        qty_to_remove -= available
+                        qty[i] = 0.0
+                    else:
+                        qty[i] = available - qty_to_remove
+                        qty_to_remove = 0.0
+
+
+def downcount(df, keys, *removals, col="Qty remaining to deliver"):
+    # One row per (Part, PO) that any round touches, one column per round
+    index = removals[0].index
+    for r in removals[1:]:
+        index = index.append(r.index).drop_duplicates()
+    per_round = np.column_stack([
+        r.reindex(index, fill_value=0).to_numpy(dtype=np.float64, copy=True) for r in removals
+    ])
+
+    # Join each row to its group (-1 = none), then sort rows by group,
+    # keeping their original order within a group
+    group = index.get_indexer(pd.MultiIndex.from_frame(keys))
+    order = np.argsort(group, kind="stable")
+    order = order[group[order] >= 0]
+    offsets = np.searchsorted(group[order], np.arange(len(index) + 1))
+
+    qty = df[col].to_numpy(dtype=np.float64, copy=True)
+    _downcount_kernel(qty, order.astype(np.int64), offsets.astype(np.int64), per_round)
+    df[col] = qty
+
+
+# -----------------------------------------------------------
+# Helper: EBU qty shipped after each (Part, PO)'s cutoff date
+# cutoffs: Series of cutoff dates indexed by (Part #, Purchasing Document)
+# -----------------------------------------------------------
+def ebu_qty_after(ebu_qty_df, cutoffs):
+    keys = ["Part #", "Purchasing Document"]
+    merged = ebu_qty_df.merge(cutoffs.rename("Cutoff").reset_index(), on=keys, how="inner")
+    after = merged[merged["Ship Date"] > merged["Cutoff"]]
+    return (
+        after.groupby(keys, sort=False, observed=True)["(f) Qty"].sum()
+        .reindex(cutoffs.index, fill_value=0)
+    )
+
+
+# -----------------------------------------------------------
+# Helper: "YYYY-MM" month labels, formatting each distinct month once.
+# Missing/unparseable dates get the "NaT" label (kept as their own month,
+# which sorts after every "YYYY-MM" column)
+# -----------------------------------------------------------
+def month_labels(dates):
+    months = dates.to_numpy(dtype="datetime64[M]")
+    codes, uniques = pd.factorize(months, use_na_sentinel=False)
+    labels = np.array([str(m) for m in uniques], dtype=object)
+    return pd.Series(labels[codes], index=dates.index)
+
+
+# -----------------------------------------------------------
+# Helper: stream DataFrames into a write-only workbook
+# Output is spooled in memory up to SPOOL_MAX_SIZE, then to disk, and sent
+# back in CHUNK_SIZE pieces
+# -----------------------------------------------------------
+SPOOL_MAX_SIZE = 32 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+def write_workbook(sheets):
+    wb = Workbook(write_only=True)
+
+    for name, df in sheets.items():
+        ws = wb.create_sheet(name)
+        ws.append(list(df.columns))
+        rows = df.astype(object).where(df.notna(), None)
+        for row in rows.itertuples(index=False, name=None):
+            ws.append(row)
+
+    # XLSX is already a ZIP: deflate at level 1 instead of zipfile's default 6
+    output = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    archive = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=1)
+    ExcelWriter(wb, archive).save()
+    output.seek(0)
+    return output
+
+
+def iter_chunks(file, chunk_size=CHUNK_SIZE):
+    with file:
+        while chunk := file.read(chunk_size):
+            yield chunk
+
+
+# -----------------------------------------------------------
+# Helper: read the "Updated" and "Price_Lookup" sheets of a /process output
+# -----------------------------------------------------------
+def read_processed(file):
+    xl = pd.ExcelFile(file, engine="calamine")
+
+    if "Updated" not in xl.sheet_names:
+        raise ValueError("Updated sheet missing")
+    if "Price_Lookup" not in xl.sheet_names:
+        raise ValueError("Price_Lookup missing")
+
+    return xl.parse("Updated"), xl.parse("Price_Lookup")
+
+
+# -----------------------------------------------------------
+# Helper: raw rows of the EBU_SHEETS present in the workbook, read straight
+# from calamine (other sheets are never loaded). _ebu_column normalises the
+# cells of a selected column the way read_excel would: integral floats -> int,
+# dates -> datetime, NA strings -> None
+# -----------------------------------------------------------
+def _ebu_cell(value):
+    if isinstance(value, float):
+        return int(value) if value.is_integer() else value
+    if isinstance(value, str):
+        return None if value in NA_STRINGS else value
+    if type(value) is date:
+        return datetime(value.year, value.month, value.day)
+    return value
+
+_ebu_column = np.vectorize(_ebu_cell, otypes=[object])
+
+def read_ebu_sheets(file):
+    wb = CalamineWorkbook.from_filelike(file)
+    try:
+        return {
+            name: wb.get_sheet_by_name(name).to_python(skip_empty_area=False)
+            for name in EBU_SHEETS if name in wb.sheet_names
+        }
+    finally:
+        wb.close()
+
+
+# -----------------------------------------------------------
+# Helper: Parse EBU once into:
+# 1) ebu_qty_df: Part #, Purchasing Document, Ship Date, (f) Qty
+# 2) price_lookup: Material, Purchasing Document, Unit_Price
+# -----------------------------------------------------------
+def parse_ebu(ebu_file_obj):
+    # Read the EBU sheets once without headers; each sheet's header row is applied below
+    ebu_sheets = read_ebu_sheets(ebu_file_obj)
+
+    # Per-sheet column arrays; stacked and converted once after the loop
+    qty_cols = ["(a)P/N&S/N", "PO Number", "Ship Date", "(f) Qty"]
+    price_cols = ["(a)P/N&S/N", "PO Number", "(g) Unit/Lot (Repair) Price"]
+    qty_parts = []
+    price_parts = []
+
+    for name, rows in ebu_sheets.items():
+        header_row = 1 if name in SPECIAL_HEADER_SHEETS else 0
+        if len(rows) <= header_row:
+            continue
+
+        # Pull only the needed columns out of the rows, by header position;
+        # only those columns' cells are normalised
+        header = [_ebu_cell(v) for v in rows[header_row]]
+        position = {}
+        for i, col in enumerate(header):
+            position.setdefault(str(col).strip(), i)
+        values = np.array(rows[header_row + 1:], dtype=object).reshape(-1, len(header))
+
+        # Quantities (Ship Date is parsed per sheet so each sheet infers its own format)
+        if set(qty_cols).issubset(position):
+            part, po, ship_date, qty = (_ebu_column(values[:, position[c]]) for c in qty_cols)
+            ship_date = pd.to_datetime(pd.Series(ship_date), errors="coerce").to_numpy()  # MM/DD/YY ok
+            qty_parts.append([part, po, ship_date, qty])
+
+        # Prices
+        if set(price_cols).issubset(position):
+            price_parts.append([_ebu_column(values[:, position[c]]) for c in price_cols])
+
+    if qty_parts:
+        part, po, ship_date, qty = (np.concatenate(arrays) for arrays in zip(*qty_parts))
+        ebu_qty_df = pd.DataFrame({
+            "Part #": part,
+            "Purchasing Document": pd.Series(po).apply(clean_po),
+            "Ship Date": ship_date,
+            "(f) Qty": pd.to_numeric(pd.Series(qty), errors="coerce").fillna(0),
+        })
+    else:
+        ebu_qty_df = pd.DataFrame(columns=["Part #", "Purchasing Document", "Ship Date", "(f) Qty"])
+
+    if price_parts:
+        material, po, price = (np.concatenate(arrays) for arrays in zip(*price_parts))
+        price_lookup = (
+            pd.DataFrame({
+                "Material": material,
+                "Purchasing Document": pd.Series(po).apply(clean_po),
+                "Unit_Price": pd.to_numeric(pd.Series(price), errors="coerce").fillna(0),
+            })
+            .drop_duplicates(subset=["Material", "Purchasing Document"], keep="last")
+            .reset_index(drop=True)
+        )
+    else:
+        price_lookup = pd.DataFrame(columns=["Material", "Purchasing Document", "Unit_Price"])
+
+    return ebu_qty_df, price_lookup
+
+
+# -----------------------------------------------------------
+# CORE: Step 1 + Step 2 downcount of the PAG file
+# Returns the Updated / Latest_Dates / Step1_Downcount / Step2_Downcount sheets
+# -----------------------------------------------------------
+def run_downcount(pag_df, ship_df, ebu_qty_df, cutoff_dt):
+    for df in [pag_df, ship_df]:
+        df.columns = df.columns.astype(str).str.strip()
+
+    pag_df.rename(columns={"Material": "Part #"}, inplace=True)
+    ship_df.rename(columns={"(a)P/N&S/N": "Part #", "PO Number": "Purchasing Document"}, inplace=True)
+
+    pag_df["Purchasing Document"] = pag_df["Purchasing Document"].apply(clean_po)
+    ship_df["Purchasing Document"] = ship_df["Purchasing Document"].apply(clean_po)
+    to_float(pag_df, ["Qty remaining to deliver"])
+    to_float(ship_df, ["Total général"])
+
+    ship_df["SlipDate"] = parse_yyyymmdd(ship_df["PackingSlip"])
+
+    # Categorical (Part, PO) keys shared by PAG / ship / EBU; pag_df keeps its
+    # original columns for the output and pag_keys holds the encoded copy
+    pag_keys = pag_df[["Part #", "Purchasing Document"]].copy()
+    for col in ["Part #", "Purchasing Document"]:
+        pag_keys[col], ship_df[col], ebu_qty_df[col] = shared_categories(
+            pag_df[col], ship_df[col], ebu_qty_df[col]
+        )
+
+    # Latest slip date and shipped total per (Part, PO) in one groupby pass
+    ship_agg = ship_df.groupby(["Part #", "Purchasing Document"], observed=True).agg(
+        SlipDate=("SlipDate", "max"),
+        Shipped=("Total général", "sum"),
+    )
+    ship_latest_dates = ship_agg["SlipDate"]
+    shipped = ship_agg["Shipped"]
+
+    step1_df = shipped.rename("Step1_Downcount").rename_axis(["Material", "Purchasing Document"]).reset_index()
+
+    # Step 2 downcount (ship-based cutoff + missing-ship cutoff_date)
+    # A) ship-based cutoff
+    ship_counts = ebu_qty_after(ebu_qty_df, ship_latest_dates.dropna())
+
+    # B) missing-from-ship cutoff (requires cutoff_dt if needed)
+    missing_ship_keys = pd.MultiIndex.from_frame(pag_keys.dropna().drop_duplicates())
+    missing_ship_keys = missing_ship_keys[~missing_ship_keys.isin(ship_latest_dates.index)]
+
+    if len(missing_ship_keys) and cutoff_dt is None:
+        raise ValueError(
+            "cutoff_date is required in Step 1 to downcount EBU for (Part, PO) not present in the shipment/receipt file."
+        )
+
+    missing_counts = ship_counts.iloc[:0]
+    if cutoff_dt is not None and len(missing_ship_keys):
+        missing_counts = ebu_qty_after(ebu_qty_df, pd.Series(cutoff_dt, index=missing_ship_keys))
+        missing_counts = missing_counts[missing_counts != 0]
+
+    ebu_counts = pd.concat([ship_counts, missing_counts])
+    step2_df = ebu_counts.rename("Step2_Downcount").rename_axis(["Material", "Purchasing Document"]).reset_index()
+
+    # Step 1 (shipped) then Step 2 (EBU) downcount, fused into one pass over pag_df
+    downcount(pag_df, pag_keys, shipped.abs(), ebu_counts)
+
+    latest_df = ship_latest_dates.rename("Latest_SlipDate").rename_axis(["Material", "Purchasing Document"]).reset_index()
+
+    return {
+        "Updated": pag_df.rename(columns={"Part #": "Material"}),
+        "Latest_Dates": latest_df,
+        "Step1_Downcount": step1_df,
+        "Step2_Downcount": step2_df,
+    }
+
+
+# -----------------------------------------------------------
+# CORE: downcount OLD by EBU rows after cutoff_dt, then diff NEW vs OLD
+# Returns the Delta_Report / Cumulative / Revenue sheets
+# -----------------------------------------------------------
+def run_delta(new_df, old_df, price_df, ebu_qty_df, cutoff_dt, cleaned=False):
+    # cleaned=True: new_df / price_df come straight from run_downcount / parse_ebu
+    # (in-process), so their headers, POs and numbers are already normalised
+    for df in [old_df] if cleaned else [new_df, old_df]:
+        df.columns = df.columns.astype(str).str.strip()
+        df.rename(columns={"Part #": "Material"}, inplace=True)
+
+        df["Purchasing Document"] = df["Purchasing Document"].apply(clean_po)
+        to_float(df, ["Qty remaining to deliver"])
+
+    price_df = price_df.copy()
+    if not cleaned:
+        price_df.columns = price_df.columns.astype(str).str.strip()
+        price_df["Purchasing Document"] = price_df["Purchasing Document"].apply(clean_po)
+        price_df["Unit_Price"] = pd.to_numeric(price_df["Unit_Price"], errors="coerce").fillna(0)
+        price_df = price_df.drop_duplicates(subset=["Material", "Purchasing Document"], keep="last")
+
+    ebu_tx = ebu_qty_df.rename(columns={"Part #": "Material"})
+
+    # Categorical (Material, PO) keys shared by NEW / OLD / price / EBU, so the
+    # groupbys, merge and pivots below run on integer codes
+    for col in ["Material", "Purchasing Document"]:
+        new_df[col], old_df[col], price_df[col], ebu_tx[col] = shared_categories(
+            new_df[col], old_df[col], price_df[col], ebu_tx[col]
+        )
+
+    ebu_tx = ebu_tx[(ebu_tx["Ship Date"].notna()) & (ebu_tx["Ship Date"] > cutoff_dt)]
+
+    ebu_counts = (
+        ebu_tx.groupby(["Material", "Purchasing Document"], observed=True)["(f) Qty"]
+        .sum()
+    )
+
+    downcount(old_df, old_df[["Material", "Purchasing Document"]], ebu_counts)
+
+    for df in [new_df, old_df]:
+        possible_cols = [
+            c for c in df.columns
+            if "stat" in c.lower() and "del" in c.lower() and "date" in c.lower()
+        ]
+        if not possible_cols:
+            raise ValueError("Missing Stat.-Rel. Del. Date column")
+        date_col = possible_cols[0]
+
+        df["Stat_Rel_Date"] = pd.to_datetime(df[date_col], errors="coerce")
+        df["Month"] = month_labels(df["Stat_Rel_Date"])
+
+    # One groupby over NEW and OLD rows tagged by side, instead of two groupbys + an outer merge
+    keys = ["Material", "Purchasing Document", "Month"]
+    combined = pd.concat([
+        new_df[keys + ["Qty remaining to deliver"]].assign(Side="New_Qty"),
+        old_df[keys + ["Qty remaining to deliver"]].assign(Side="Old_Qty"),
+    ], ignore_index=True)
+
+    merged = (
+        combined.groupby(keys + ["Side"], observed=True)["Qty remaining to deliver"].sum()
+        .unstack("Side", fill_value=0)
+        .reindex(columns=["New_Qty", "Old_Qty"], fill_value=0)
+        .rename_axis(columns=None)
+        .reset_index()
+    )
+
+    merged["Delta"] = merged["New_Qty"] - merged["Old_Qty"]
+
+    merged = merged.merge(
+        price_df[["Material", "Purchasing Document", "Unit_Price"]],
+        on=["Material", "Purchasing Document"], how="left"
+    ).fillna({"Unit_Price": 0})
+
+    merged["Revenue"] = merged["Delta"] * merged["Unit_Price"]
+
+    # merged has one row per (Material, PO, Month): one unstack reshapes
+    # Delta and Revenue together, no re-aggregation
+    both = (
+        merged.set_index(["Material", "Purchasing Document", "Month"])[["Delta", "Revenue"]]
+        .unstack("Month", fill_value=0)
+    )
+
+    # Month columns come out string-sorted under each value ("NaT" last);
+    # boolean masks rather than both["Delta"], which raises when there are no months
+    value = both.columns.get_level_values(0)
+    month_cols = list(both.columns[value == "Delta"].get_level_values("Month"))
+
+    pivot = both.loc[:, value == "Delta"].set_axis(month_cols, axis=1).reset_index()
+    revenue_pivot = both.loc[:, value == "Revenue"].set_axis(month_cols, axis=1).reset_index()
+
+    cumulative = pivot.copy()
+    cumulative[month_cols] = pivot[month_cols].cumsum(axis=1)
+
+    return {
+        "Delta_Report": pivot,
+        "Cumulative": cumulative,
+        "Revenue": revenue_pivot,
+    }
@@ -0,0 +1,99 @@
+import pandas as pd
+
+from pag_core import run_delta
+
+
+def frames(new_dates, old_dates):
+    def side(dates, qty):
+        return pd.DataFrame({
+            "Material": ["A"] * len(dates),
+            "Purchasing Document": ["4500000001"] * len(dates),
+            "Qty remaining to deliver": qty,
+            "Stat.-Rel. Del. Date": dates,
+        })
+
+    new_df = side(new_dates, [10.0] * len(new_dates))
+    old_df = side(old_dates, [4.0] * len(old_dates))
+    price_df = pd.DataFrame({
+        "Material": ["A"], "Purchasing Document": ["4500000001"], "Unit_Price": [2.0],
+    })
+    ebu_qty_df = pd.DataFrame({  # as parse_ebu returns it with no shipments
+        "Part #": pd.Series([], dtype=object),
+        "Purchasing Document": pd.Series([], dtype=object),
+        "Ship Date": pd.Series([], dtype="datetime64[ns]"),
+        "(f) Qty": pd.Series([], dtype=float),
+    })
+    return new_df, old_df, price_df, ebu_qty_df
+
+
+def test_blank_delivery_date_kept_under_nat_month():
+    out = run_delta(
+        *frames(["2024-02-15", "", "2024-01-10"], ["2024-01-20", None]),
+        pd.Timestamp("2024-01-01"),
+    )
+
+    delta = out["Delta_Report"]
+    assert list(delta.columns) == [
+        "Material", "Purchasing Document", "2024-01", "2024-02", "NaT",
+    ]
+    assert delta[["2024-01", "2024-02", "NaT"]].iloc[0].tolist() == [6.0, 10.0, 6.0]
+    assert out["Cumulative"][["2024-01", "2024-02", "NaT"]].iloc[0].tolist() == [6.0, 16.0, 22.0]
+    assert out["Revenue"][["2024-01", "2024-02", "NaT"]].iloc[0].tolist() == [12.0, 20.0, 12.0]
+
+
+def test_matches_original_month_pivots():
+    # Expected values produced by the original per-row to_period("M") implementation
+    new_df = pd.DataFrame({
+        "Material": ["A", "A", "A", "B", "B", "B"],
+        "Purchasing Document": ["4500000001"] * 3 + ["4500000002"] * 3,
+        "Qty remaining to deliver": [10.0, 5.0, 7.0, 3.0, 8.0, 2.0],
+        "Stat.-Rel. Del. Date": [
+            "2024-01-10", "2024-03-05", "", "2024-02-20", "not a date", "2024-02-01",
+        ],
+    })
+    old_df = pd.DataFrame({
+        "Material": ["A", "A", "B", "B", "C"],
+        "Purchasing Document": [
+            "4500000001", "4500000001", "4500000002", "4500000002", "4500000003",
+        ],
+        "Qty remaining to deliver": [6.0, 4.0, 5.0, 9.0, 1.0],
+        "Stat.-Rel. Del. Date": ["2024-01-15", None, "2024-02-10", "2024-04-01", ""],
+    })
+    price_df = pd.DataFrame({
+        "Material": ["A", "B", "C"],
+        "Purchasing Document": ["4500000001", "4500000002", "4500000003"],
+        "Unit_Price": [2.0, 1.5, 10.0],
+    })
+    ebu_qty_df = pd.DataFrame({  # as parse_ebu returns it: cleaned integer POs
+        "Part #": ["A", "B"],
+        "Purchasing Document": [4500000001, 4500000002],
+        "Ship Date": pd.to_datetime(["2024-01-20", "2023-12-01"]),
+        "(f) Qty": [3.0, 4.0],
+    })
+
+    out = run_delta(new_df, old_df, price_df, ebu_qty_df, pd.Timestamp("2024-01-01"))
+
+    columns = [
+        "Material", "Purchasing Document", "2024-01", "2024-02", "2024-03", "2024-04", "NaT",
+    ]
+    expected = {
+        "Delta_Report": [
+            ["A", 4500000001, 7.0, 0.0, 5.0, 0.0, 3.0],
+            ["B", 4500000002, 0.0, 0.0, 0.0, -9.0, 8.0],
+            ["C", 4500000003, 0.0, 0.0, 0.0, 0.0, -1.0],
+        ],
+        "Cumulative": [
+            ["A", 4500000001, 7.0, 7.0, 12.0, 12.0, 15.0],
+            ["B", 4500000002, 0.0, 0.0, 0.0, -9.0, -1.0],
+            ["C", 4500000003, 0.0, 0.0, 0.0, 0.0, -1.0],
+        ],
+        "Revenue": [
+            ["A", 4500000001, 14.0, 0.0, 10.0, 0.0, 6.0],
+            ["B", 4500000002, 0.0, 0.0, 0.0, -13.5, 12.0],
+            ["C", 4500000003, 0.0, 0.0, 0.0, 0.0, -10.0],
+        ],
+    }
+    for sheet, rows in expected.items():
+        df = out[sheet]
+        assert list(df.columns) == columns
+        assert df.astype(object).values.tolist() == rows
@@ -0,0 +1,19 @@
+import pandas as pd
+
+from pag_core import parse_yyyymmdd
+
+
+def test_long_integers_keep_their_leading_date():
+    values = pd.Series([20240131999999999, 20240131, 2024013112, 1234567])
+    assert parse_yyyymmdd(values).tolist() == [
+        pd.Timestamp("2024-01-31"), pd.Timestamp("2024-01-31"), pd.Timestamp("2024-01-31"), pd.NaT,
+    ]
+
+
+def test_floats_and_strings():
+    assert parse_yyyymmdd(pd.Series([2024013112.0, float("nan")])).tolist() == [
+        pd.Timestamp("2024-01-31"), pd.NaT,
+    ]
+    assert parse_yyyymmdd(pd.Series(["20240131ABC", "x", None])).tolist() == [
+        pd.Timestamp("2024-01-31"), pd.NaT, pd.NaT,
+    ]